@@ -11,6 +11,8 @@ import json
 import logging
 import sys
 
+from contextlib import closing
+from operator import itemgetter
 from typing import Generator
 
 from .dewdrop import DeweyData
@@ -19,15 +21,17 @@ from .dewdrop import DeweyData
 def info_writer(finfo: Generator, delimiter: str="\t") -> None:
     """Write file info to stdout."""
     row = next(finfo)
-    wtr = csv.DictWriter(sys.stdout, delimiter=delimiter, fieldnames=row.keys())
-    wtr.writeheader()
-    wtr.writerow(row)
-    wtr.writerows(finfo)
+    keys = list(row)
+    # every row has the same fields, so pull values out in header order
+    # instead of having DictWriter check and map each row
+    values = itemgetter(*keys) if len(keys) > 1 else lambda r: (r[keys[0]],)
+    wtr = csv.writer(sys.stdout, delimiter=delimiter)
+    wtr.writerow(keys)
+    wtr.writerow(values(row))
+    wtr.writerows(map(values, finfo))
 
 
 def main():
-    dew = DeweyData()
-
     argp = argparse.ArgumentParser(description="Fetch data from Dewey Data.")
     subp = argp.add_subparsers(dest="cmd", required=True)
 
@@ -37,27 +41,24 @@ def main():
     argp.add_argument("-v", "--verbose", action="store_true", help="Enable log.")
     argp.add_argument("--params", type=json.loads, help="Additional parameters.")
     argp.add_argument("--debug", action="store_true", help="Enable debug mode.")
-    argp.add_argument("--sleep", type=float, default=1.0, help="Delay between requests")
+    argp.add_argument("--sleep", type=float, default=1.0, help="Delay between API requests")
+    argp.add_argument("--burst", type=int, default=1, help="API requests allowed without delay")
 
-    meta = subp.add_parser("meta", help="Fetch metadata for product.", parents=[comm])
-    meta.set_defaults(func=dew.get_meta)
+    subp.add_parser("meta", help="Fetch metadata for product.", parents=[comm])
 
     down = subp.add_parser("download", help="Download files for product.", parents=[comm])
     down.add_argument("dirpath", type=str, help="Directory to save files to.")
     down.add_argument("-n", "--no-partition", action="store_false", help="Do not partition files.")
     down.add_argument("-s", "--sep", type=str, default="\t", help="Output delimiter.")
     down.add_argument("-c", "--clobber", action="store_true", help="Overwrite existing files.")
-    down.set_defaults(func=dew.download_files)
+    down.add_argument("-w", "--workers", type=int, default=8, help="Concurrent downloads.")
+    down.add_argument("-p", "--parts", type=int, default=1, help="Connections per large file.")
 
     roll = subp.add_parser("list", help="List files for product.", parents=[comm])
     roll.add_argument("-s", "--sep", type=str, default="\t", help="Output delimiter.")
-    roll.set_defaults(func=dew.list_files)
 
 
     opts = argp.parse_args()
-    dew.request_delay = opts.sleep
-    if opts.key:
-        dew._key = opts.key
     if opts.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
@@ -67,20 +68,26 @@ def main():
 
     if opts.debug: sys.exit(0)
 
-    if opts.cmd == "meta":
-        print(
-            json.dumps(opts.func(opts.product, **params), indent=4)
-        )
-
-    elif opts.cmd == "download":
-        finfo = opts.func(
-            opts.dirpath, opts.product, opts.no_partition, opts.clobber, **params
-        )
-        info_writer(finfo, delimiter=opts.sep)
-
-    elif opts.cmd == "list":
-        finfo = opts.func(opts.product, **params)
-        info_writer(finfo, delimiter=opts.sep)
+    # only set up the client once there is a command to run, then reuse its
+    # pooled session for every request and close it when done
+    with DeweyData(key=opts.key or None, sleep=opts.sleep, burst=opts.burst) as dew:
+        if opts.cmd == "meta":
+            print(
+                json.dumps(dew.get_meta(opts.product, **params), indent=4)
+            )
+
+        elif opts.cmd == "download":
+            finfo = dew.download_files(
+                opts.dirpath, opts.product, opts.no_partition, opts.clobber,
+                workers=opts.workers, parts=opts.parts, **params
+            )
+            # close the generator on Ctrl-C so running downloads are stopped
+            with closing(finfo):
+                info_writer(finfo, delimiter=opts.sep)
+
+        elif opts.cmd == "list":
+            finfo = dew.list_files(opts.product, **params)
+            info_writer(finfo, delimiter=opts.sep)
 
 
 if __name__ == "__main__":
@@ -3,59 +3,231 @@
 Interact with Dewey Data API.
 """
 
+import json
 import logging
 import os
+import random
 import requests
+import threading
 import time
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import Generator
+from typing import BinaryIO, Generator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# read downloads in pieces of this many bytes rather than buffering whole files
+CHUNK_SIZE = 1 << 20
+
+# size of each byte range when a file is fetched over several connections
+RANGE_SIZE = 1 << 24
+
+# write downloads out to disk and drop them from the page cache this often
+DROP_CACHE_SIZE = 1 << 26
+
+# errors from a connection dropping while a streamed body is being read
+_STREAM_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ContentDecodingError,
+)
+
+
+class _Stopped(Exception):
+    """Raised in worker threads when the session is stopping its downloads."""
+
+
+class _SizeMismatch(requests.RequestException):
+    """Raised when a download doesn't match the size given in the file list."""
+
+
+def _retry_after(resp: requests.Response|None) -> float|None:
+    """Seconds a throttled response asks us to wait before trying again."""
+
+    if resp is None or resp.status_code not in (429, 503):
+        return None
+
+    value = resp.headers.get("Retry-After", "").strip()
+    if value.isdigit():
+        return float(value)
+
+    # the header can also be an HTTP date
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _expected_size(file: dict) -> int|None:
+    """Size in bytes the file list reports for a file, if it has one."""
+
+    for field in ("file_size_bytes", "file_size"):
+        try:
+            return int(file[field])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _part_path(fpath: Path) -> Path:
+    """Path a download is streamed to before it is complete."""
+    return fpath.with_name(fpath.name + ".part")
+
+
+def _drop_cache(f: BinaryIO) -> None:
+    """Write out a file's data and drop it from the page cache."""
+
+    # DONTNEED only releases clean pages, so force the writeback first
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _write_stream(resp: requests.Response, f: BinaryIO, stop: threading.Event) -> None:
+    """Write a streamed response body to an open file until done or told to stop."""
+
+    # downloaded files aren't read back here, so every so often push what has
+    # been written out of the page cache rather than crowding out everything else
+    drop = hasattr(os, "posix_fadvise")
+    unsynced = 0
+    for chunk in resp.iter_content(CHUNK_SIZE):
+        if stop.is_set():
+            raise _Stopped()
+        f.write(chunk)
+        unsynced += len(chunk)
+        if drop and unsynced >= DROP_CACHE_SIZE:
+            _drop_cache(f)
+            unsynced = 0
+
+    if drop and unsynced:
+        _drop_cache(f)
+
+
+def _finished(done: set[Future], mismatched: list) -> Generator[dict, None, None]:
+    """Yield finished downloads, setting aside those with the wrong size."""
+
+    for fut in done:
+        try:
+            yield fut.result()
+        except _SizeMismatch as e:
+            logging.error("%s", e)
+            mismatched.append(e)
 
 
 class ExtendedSession(requests.Session):
     """A requests session that retries and delays requests as needed."""
 
-    def __init__(self, max_tries: int = 5, delay: float = 1.0, headers: dict|None = None):
+    def __init__(
+            self, max_tries: int = 5, delay: float = 1.0, headers: dict|None = None,
+            burst: int = 1
+        ):
         super().__init__()
         self.headers.update(headers or {})
 
+        # downloads, ranges and page prefetches all share this session from
+        # different threads, so allow more pooled connections than the default 10;
+        # retries are handled below rather than by urllib3
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
         self.max_tries: int = int(max_tries)
         self.retry_delay: float = 180
+        self.max_backoff: float = 900
         self.request_delay: float = float(delay)
-        self._last_request_time: float = 0
+        self.burst: int = int(burst)
+        self._tokens: float = float(self.burst)
+        self._last_refill: float = time.monotonic()
+        self._delay_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _sleep(self, seconds: float) -> None:
+        """Sleep, waking early if the session is stopping its downloads."""
+        if self._stopping.wait(seconds):
+            raise _Stopped()
 
     def _delay(self) -> None:
         """Delay between requests."""
-        time_since_last_request = time.time() - self._last_request_time
-        if time_since_last_request < self.request_delay:
-            time.sleep(self.request_delay - time_since_last_request)
-        self._last_request_time = time.time()
-
-    def request(self, method: str|bytes, url: str|bytes, **kwargs) -> requests.Response:  # pyright: ignore
-        """Make a request with retries and delays as necessary."""
-
-        if self.request_delay > 0:
+        # token bucket shared by all threads: one token comes back every
+        # request_delay seconds, and up to burst of them can be saved up
+        with self._delay_lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.burst), self._tokens + (now - self._last_refill) / self.request_delay
+            )
+            self._last_refill = now
+
+            if self._tokens < 1:
+                wait = (1 - self._tokens) * self.request_delay
+                self._sleep(wait)
+                self._tokens = 1
+                self._last_refill = now + wait
+
+            self._tokens -= 1
+
+    def _backoff(self, tries: int, resp: requests.Response|None = None) -> None:
+        """Wait before another try after tries failed attempts."""
+        # wait as long as the server asks when it is throttling us,
+        # otherwise full jitter keeps concurrent retries from landing together
+        wait = _retry_after(resp)
+        if wait is not None:
+            self._sleep(wait + random.uniform(0, 1))
+        else:
+            backoff = min(self.max_backoff, self.retry_delay * (2 ** (tries - 1)))
+            self._sleep(random.uniform(0, backoff))
+
+    def request(  # pyright: ignore
+            self, method: str|bytes, url: str|bytes, throttle: bool = True,
+            max_tries: int|None = None, quiet: bool = False, accept: tuple[int, ...] = (),
+            **kwargs
+        ) -> requests.Response:
+        """Make a request with retries and delays as necessary.
+
+        Requests with throttle set to False are retried but not delayed. Setting
+        max_tries overrides the session's retry limit, and quiet requests only
+        log their failures at debug level. Responses with a status in accept
+        are returned as they are instead of being treated as failures.
+        """
+
+        if throttle and self.request_delay > 0:
             self._delay()
 
+        max_tries = self.max_tries if max_tries is None else int(max_tries)
+        failed = logging.DEBUG if quiet else logging.ERROR
+        refused = logging.DEBUG if quiet else logging.CRITICAL
+
         tries = 0
-        while tries < self.max_tries:
+        while tries < max_tries:
             tries += 1
 
             try:
                 resp = super().request(method, url, **kwargs)
+                if resp.status_code in accept:
+                    return resp
 
-                # don't bother retrying if not found or access denied
-                if resp.status_code in (403, 404):
-                    logging.critical("Request to %s failed with status %d", url, resp.status_code)
+                # don't bother retrying a bad request, not found or access denied
+                if resp.status_code in (400, 401, 403, 404):
+                    logging.log(refused, "Request to %s failed with status %d", url, resp.status_code)
                     break
 
                 resp.raise_for_status()
                 return resp
 
             except requests.RequestException as e:
-                logging.error("Request failed: %s", e)
-                if tries < self.max_tries:
-                    time.sleep(self.retry_delay * (2 ** (tries - 1)))
+                logging.log(failed, "Request failed: %s", e)
+                if tries < max_tries:
+                    self._backoff(tries, e.response)
                     logging.debug("Retrying request to %s", url)
 
         raise requests.RequestException(
@@ -66,10 +238,12 @@ class ExtendedSession(requests.Session):
 class DeweyData(ExtendedSession):
     """Interact with Dewey Data API."""
 
-    def __init__(self, key: str|None = None, sleep: float = 1.0):
+    def __init__(self, key: str|None = None, sleep: float = 1.0, burst: int = 1):
 
-        super().__init__(delay = float(sleep))
+        super().__init__(delay = float(sleep), burst = int(burst))
         self._base_url = "https://app.deweydata.io/external-api/v3/products"
+        self.page_prefetch: int = 4
+        self._meta: dict[tuple[str, str], dict] = {}
         self.key = os.getenv("DEWEY_API_KEY") if key is None else key
 
     @property
@@ -86,90 +260,365 @@ class DeweyData(ExtendedSession):
         headers = {"X-API-KEY": self._key, "accept": "application/json"}
         self.headers.update(headers)
 
-    def _get(self, url: str, params: dict|None = None) -> dict:
+    def _get(self, url: str, params: dict|None = None, **kwargs) -> dict:
         """Make an API request."""
-        return self.request("GET", url, params=params).json()
+        resp = self.request("GET", url, params=params, **kwargs)
+        # file list pages can be large, so parse them with orjson when it's installed
+        return orjson.loads(resp.content) if orjson is not None else resp.json()
+
+    @staticmethod
+    def _meta_key(product: str, params: dict) -> tuple[str, str]:
+        """Key for cached metadata."""
+        return product, json.dumps(params, sort_keys=True)
 
     def get_meta(self, product: str, **kwargs) -> dict:
         """Download metadata for product."""
 
-        logging.debug("Fetching metadata for %s", product)
-        return self._get(f"{self._base_url}/{product}/files/metadata", kwargs)
+        # metadata doesn't change within a session, so fetch it once per query
+        key = self._meta_key(product, kwargs)
+        if key not in self._meta:
+            logging.debug("Fetching metadata for %s", product)
+            self._meta[key] = self._get(f"{self._base_url}/{product}/files/metadata", kwargs)
+        return self._meta[key]
 
     def get_files(self, product: str, **kwargs) -> Generator[dict, None, None]:
         """Download metadata for product."""
 
-        # use metadata to determine default partitioning
-        meta = self.get_meta(product)
-
-        if meta["partition_type"] == "DATE":
-            params: dict = {
-                "partition_key_after": "1900-01-01", "partition_key_before": "2099-12-31"
-            }
-        else:
-            params = {}
+        url = f"{self._base_url}/{product}/files"
+        prefetch = max(1, int(self.page_prefetch))
+        ex = ThreadPoolExecutor(max_workers=max(2, prefetch))
+
+        # most products are partitioned by date, so unless the metadata is
+        # already known, ask for the first page with date params while it loads
+        # and only fetch that page again if the guess was wrong; the guess gets a
+        # single quiet try so a product that rejects the params costs one request
+        date_params: dict = {
+            "partition_key_after": "1900-01-01", "partition_key_before": "2099-12-31"
+        } | kwargs
+        guess = None
+        if self._meta_key(product, {}) not in self._meta:
+            guess = ex.submit(
+                self._get, url, date_params | {"page": 1}, max_tries=1, quiet=True
+            )
 
-        params |= kwargs
+        try:
+            # use metadata to determine default partitioning
+            meta = self.get_meta(product)
 
-        i = 1
+            if meta["partition_type"] == "DATE":
+                params = date_params
+            else:
+                params = dict(kwargs)
+                if guess is not None:
+                    guess.cancel()
+                guess = None
+
+            if guess is None or guess.exception() is not None:
+                guess = ex.submit(self._get, url, params | {"page": 1})
+
+            # once a page says how many there are, keep the next few pages loading
+            # in the background while the caller works through the current one
+            ahead: deque[Future] = deque([guess])
+            i = 1
+            while ahead:
+                response = ahead.popleft().result()
+                while i < response["total_pages"] and len(ahead) < prefetch:
+                    i += 1
+                    ahead.append(ex.submit(self._get, url, params | {"page": i}))
+
+                logging.debug(
+                    "Fetched page %d of %d for %s file list",
+                    response["page"], response["total_pages"], product
+                )
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(
+                        f"""
+                        ===== {product} =====
+                        Page: {response["page"]}
+                        Number of Files for Page: {response["number_of_files_for_page"]}
+                        Average File Size for Page: {response["avg_file_size_for_page"]}
+                        Total Files: {response["total_files"]}
+                        Total Pages: {response["total_pages"]}
+                        Total Size: {response["total_size"]}
+                        Expires At: {response["expires_at"]}
+                        """
+                    )
+
+                links = response.pop("download_links")
+                yield from (d | response for d in links)
+        finally:
+            ex.shutdown(wait=True, cancel_futures=True)
+
+    def _retry_stream(self, tries: int, err: Exception, link: str) -> None:
+        """Wait to pick up a download that was cut off, or give up after max_tries."""
+
+        logging.error("Download from %s failed: %s", link, err)
+        if tries >= self.max_tries:
+            raise requests.RequestException(
+                f"Download from {link} failed after {tries} {'try' if tries == 1 else 'tries'}"
+            ) from err
+
+        self._backoff(tries)
+        logging.debug("Resuming download from %s", link)
+
+    def _fetch_range(self, link: str, path: Path, start: int, end: int) -> None:
+        """Download bytes start through end of a file into the same place in path."""
+
+        # the body is read after request() has returned, so a connection cut off
+        # partway is retried here, asking only for the bytes still missing
+        pos = start
+        tries = 0
         while True:
-            params["page"] = i
-            response = self._get(f"{self._base_url}/{product}/files", params)
-            logging.debug(
-                "Fetched page %d of %d for %s file list", i, response["total_pages"], product
-            )
-            logging.debug(
-                f"""
-                ===== {product} =====
-                Page: {response["page"]}
-                Number of Files for Page: {response["number_of_files_for_page"]}
-                Average File Size for Page: {response["avg_file_size_for_page"]}
-                Total Files: {response["total_files"]}
-                Total Pages: {response["total_pages"]}
-                Total Size: {response["total_size"]}
-                Expires At: {response["expires_at"]}
-                """
-            )
+            tries += 1
+            headers = {"Range": f"bytes={pos}-{end}"}
+            try:
+                with (
+                    self.request("GET", link, headers=headers, stream=True, throttle=False) as resp,
+                    open(path, "r+b") as f,
+                ):
+                    if (
+                        resp.status_code != 206
+                        or not resp.headers.get("Content-Range", "").startswith(f"bytes {pos}-")
+                    ):
+                        raise requests.RequestException(f"Range request to {link} was not honored")
+
+                    f.seek(pos)
+                    try:
+                        _write_stream(resp, f, self._stopping)
+                    finally:
+                        pos = f.tell()
+                break
+            except _STREAM_ERRORS as e:
+                self._retry_stream(tries, e, link)
 
-            links = response.pop("download_links")
-            yield from (d | response for d in links)
+        if pos != end + 1:
+            raise requests.RequestException(
+                f"Range request to {link} ended at byte {pos} instead of {end + 1}"
+            )
 
-            if i >= response["total_pages"]:
+    def _download_ranges(self, link: str, fpath: Path, parts: int, size: int|None) -> bool:
+        """Download a file as byte ranges over several connections at once.
+
+        Returns False without downloading anything if the server doesn't
+        support range requests or the file fits in a single range.
+        """
+
+        # the delay between requests is meant for the API, so file downloads,
+        # and each range of them, skip it rather than being held to one a second;
+        # servers that support ranges answer this probe with 206 and the full size
+        headers = {"Range": "bytes=0-0"}
+        with self.request("GET", link, headers=headers, stream=True, throttle=False) as resp:
+            total = None
+            if resp.status_code == 206:
+                total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                total = int(total) if total.isdigit() else None
+
+        if size is not None and total is not None and total != size:
+            raise _SizeMismatch(f"File at {link} is {total} bytes, expected {size}")
+
+        if total is None or total <= RANGE_SIZE:
+            return False
+
+        # ranges arrive out of order, so this can't be resumed like a .part file
+        tmp = fpath.with_name(fpath.name + ".tmp")
+        try:
+            with open(tmp, "wb") as f:
+                f.truncate(total)
+
+            starts = range(0, total, RANGE_SIZE)
+            ex = ThreadPoolExecutor(max_workers=min(parts, len(starts)))
+            try:
+                for fut in [
+                    ex.submit(self._fetch_range, link, tmp, a, min(a + RANGE_SIZE, total) - 1)
+                    for a in starts
+                ]:
+                    fut.result()
+            finally:
+                # don't start the ranges still queued once one has failed
+                ex.shutdown(wait=True, cancel_futures=True)
+
+            tmp.replace(fpath)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        return True
+
+    def _fetch_part(self, file: dict, part: Path) -> None:
+        """Download a file into its partial file, continuing any data already there."""
+
+        # resume a partial file from an earlier try, starting one byte early so
+        # a partial file that is already complete still gets a 206 and not a 416
+        offset = max(0, part.stat().st_size - 1) if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+
+        link = file["link"]
+        accept = (416,) if offset else ()
+        with self.request(
+            "GET", link, headers=headers, stream=True, throttle=False, accept=accept
+        ) as resp:
+            # the partial file runs past the end of the remote one, so start over
+            if resp.status_code == 416:
+                logging.warning(
+                    "Partial file %s is longer than the file at %s, starting over", part, link
+                )
+                part.unlink()
+                return self._fetch_part(file, part)
+
+            resumed = resp.status_code == 206
+            if resumed and not resp.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+                raise requests.RequestException(f"Range request to {link} was not honored")
+            if resumed:
+                logging.debug("Resuming %s at byte %d", file["file_name"], offset)
+
+            with open(part, "r+b" if resumed else "wb") as f:
+                f.seek(offset if resumed else 0)
+                _write_stream(resp, f, self._stopping)
+                f.truncate()
+
+    def _download(self, file: dict, fpath: Path, parts: int = 1) -> dict:
+        """Download a single file to the given path in an existing directory."""
+
+        logging.debug("Downloading %s", file["file_name"])
+
+        # stream to a partial file and rename it once complete, so an interrupted
+        # download is never mistaken for a finished one on the next run
+        part = _part_path(fpath)
+        size = _expected_size(file)
+
+        # a partial file longer than the listed size can't be resumed
+        if size is not None and part.exists() and part.stat().st_size > size:
+            logging.warning("Partial file %s is longer than %d bytes, starting over", part, size)
+            part.unlink()
+
+        # files the list says fit in one range go straight to a single stream
+        ranged = parts > 1 and not part.exists() and (size is None or size > RANGE_SIZE)
+        if ranged:
+            if self._download_ranges(file["link"], fpath, parts, size):
+                return file
+
+        # the body is read after request() has returned, so a connection cut off
+        # partway is retried here, carrying on from what reached the partial file
+        tries = 0
+        while True:
+            tries += 1
+            try:
+                self._fetch_part(file, part)
                 break
-            i += 1
+            except _STREAM_ERRORS as e:
+                self._retry_stream(tries, e, file["link"])
+
+        # a short file can be resumed next time, a long one has to start over
+        if size is not None and part.stat().st_size != size:
+            got = part.stat().st_size
+            if got > size:
+                part.unlink()
+            raise _SizeMismatch(
+                f"Downloaded {got} bytes from {file['link']}, expected {size}"
+            )
+        part.replace(fpath)
+
+        return file
 
     def download_files(
-            self, dirpath: str, product: str, partition: bool=True, clobber: bool=False, **kwargs
+            self, dirpath: str, product: str, partition: bool=True, clobber: bool=False,
+            workers: int=8, parts: int=1, **kwargs
         ) -> Generator[dict, None, None]:
-        """Download files for product."""
+        """Download files for product, yielding file info as each one finishes.
+
+        With parts above one, large files are fetched as that many byte ranges
+        at a time when the server supports range requests.
+        """
 
         dp = Path(dirpath)
         dp.mkdir(parents=True, exist_ok=True)
 
-        for file in self.get_files(product, **kwargs):
+        # downloads are network bound, so run several at once and only keep a
+        # small backlog queued so the file list is still fetched lazily
+        workers = max(1, int(workers))
+        ex = ThreadPoolExecutor(max_workers=workers)
+        pending: set[Future] = set()
+        # many files share a partition directory, so only create each one once
+        made: set[Path] = {dp}
+        # file names can repeat within a directory, so keep the first listed copy
+        # rather than having two downloads write the same partial file at once
+        queued: set[Path] = set()
+        # a listed size that is wrong shouldn't stop every other download,
+        # so those failures are reported once all the rest are done
+        mismatched: list[_SizeMismatch] = []
+        # list what's already downloaded in one pass instead of a stat per file,
+        # following symlinked partition directories as exists() would; files
+        # downloaded during this run are caught by the queued check instead
+        have: set[Path] = set()
+        if not clobber:
+            have = {
+                Path(root, name)
+                for root, _, names in os.walk(dp, followlinks=True) for name in names
+            }
+        self._stopping.clear()
+        files = self.get_files(product, **kwargs)
+        try:
+            for file in files:
 
-            if partition and file['partition_key'] is not None:
-                fpath = dp / file["partition_key"] / file["file_name"]
-            else:
-                # file names can repeat across pages of the same product,
-                # include page number in the path for multi-page products
-                if file["total_pages"] == 1:
-                    fpath = dp / file["file_name"]
+                if partition and file['partition_key'] is not None:
+                    fpath = dp / file["partition_key"] / file["file_name"]
                 else:
-                    fpath = dp / f"page-{file['page']}" / file["file_name"]
-
-            if not clobber and fpath.exists():
-                logging.debug("Skipping existing file %s", fpath)
-                continue
-
-            logging.debug("Downloading %s", file["file_name"])
-            req = self.request("GET", file["link"])
-
-            fpath.parent.mkdir(parents=True, exist_ok=True)
-            with open(fpath, "wb") as f:
-                f.write(req.content)
-
-            yield file
+                    # file names can repeat across pages of the same product,
+                    # include page number in the path for multi-page products
+                    if file["total_pages"] == 1:
+                        fpath = dp / file["file_name"]
+                    else:
+                        fpath = dp / f"page-{file['page']}" / file["file_name"]
+
+                if fpath in queued:
+                    logging.debug("Skipping %s, already downloading it", fpath)
+                    continue
+
+                if fpath in have:
+                    # keep existing files that match the listed size, or any
+                    # existing file if the list doesn't give one
+                    size = _expected_size(file)
+                    have_size = fpath.stat().st_size if size is not None else None
+                    if have_size == size:
+                        logging.debug("Skipping existing file %s", fpath)
+                        continue
+
+                    logging.warning(
+                        "Existing file %s is %d bytes, expected %d", fpath, have_size, size
+                    )
+                    # a short file is most likely a download cut off before
+                    # partial files were used, so pick up where it stopped
+                    if have_size < size:
+                        fpath.replace(_part_path(fpath))
+
+                if fpath.parent not in made:
+                    fpath.parent.mkdir(parents=True, exist_ok=True)
+                    made.add(fpath.parent)
+
+                pending.add(ex.submit(self._download, file, fpath, parts))
+                queued.add(fpath)
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from _finished(done, mismatched)
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from _finished(done, mismatched)
+
+            if mismatched:
+                raise requests.RequestException(
+                    f"{len(mismatched)} {'file' if len(mismatched) == 1 else 'files'} "
+                    "did not match the size in the file list"
+                )
+        except BaseException:
+            # on an error, interrupt or early close, have running downloads stop
+            # after their current chunk rather than waiting for them to finish
+            self._stopping.set()
+            raise
+        finally:
+            files.close()
+            ex.shutdown(wait=True, cancel_futures=True)
+            self._stopping.clear()
 
     def list_files(self, product: str, **kwargs) -> Generator[dict, None, None]:
         """List files for product."""